@@ -1,13 +1,133 @@
-from flask import Flask, abort, send_file, send_from_directory # the web framework we are using for handling incoming requests
+from gevent import monkey # gevent lets one server process handle many requests at once, switching between them whenever one is waiting on the network
+monkey.patch_all() # make the standard library's networking, threads and sleeping cooperate with gevent (this must happen before anything else is imported)
+from gevent import spawn # for doing two things at once within a request
+from gevent import Timeout # for limiting how long something can take
+
+from flask import Flask, abort, redirect, send_file, send_from_directory # the web framework we are using for handling incoming requests
+from werkzeug.exceptions import default_exceptions # the error responses Flask uses, by HTTP status code
 import requests # the library used for nice and simple HTTP requests (for communicating with SendOwl's API)
-import psycopg2 # the library used for interaction with PostgreSQL for storing license keys
+from requests.adapters import HTTPAdapter # lets us configure how the requests library keeps connections open and retries
+from urllib3.util.retry import Retry # the retry rules used by requests (it is built on urllib3)
+import orjson # a fast JSON parser, for reading SendOwl's responses
+import redis # the library used to talk to Redis, where recent successful verifications are cached
+from psycopg_pool import ConnectionPool # a thread-safe pool of PostgreSQL connections (for storing license keys) that are reused between requests
 
 from os import environ # used to acess environment variables on the server side
-from time import sleep # for waiting between attempts to request
+from threading import Thread # for counting requests in the background
+from time import monotonic # for measuring how long we have been gathering requests to count
+import weakref # for remembering things about database connections without keeping them open
+import queue # for handing requests to count over to the background thread
+import random # for spreading out retries to SendOwl
 
-TIMEOUT = 5 # The amount of time in seconds to wait for SendOwl to return from our request
+CONNECT_TIMEOUT = 2 # The amount of time in seconds to wait for a connection to SendOwl to open
+TIMEOUT = 5 # The amount of time in seconds to wait for SendOwl to return from our request once connected
 TRY_INTERVAL = 1 # The amount of time in seconds between tries to request from SendOwl
 TRY_COUNT = 10 # The number of request tries to SendOwl before giving up
+MAX_BACKOFF = 8 # The longest time in seconds to wait between two tries, however many tries have failed
+DEADLINE = TRY_COUNT * TIMEOUT # The longest time in seconds a request to SendOwl can take in total, however many tries are left
+CACHE_TTL = 600 # The amount of time in seconds to remember that SendOwl said a key is valid for a HID, before asking SendOwl again
+FLUSH_INTERVAL = 0.05 # The amount of time in seconds to gather requests to count before adding them to the database
+FLUSH_BATCH_SIZE = 500 # The most requests to count that are added to the database at once
+DB_IDLE_CHECK_AFTER = 30 # The amount of time in seconds a database connection can sit unused before we check it still works before using it again
+DB_CONNECT_TIMEOUT = 3 # The amount of time in seconds to wait for a new database connection to open
+POOL_MIN_SIZE = 2 # The number of database connections each server process keeps open even when idle
+POOL_MAX_SIZE = int(environ.get('PG_POOL_SIZE', '10')) # The most database connections each server process may have open at once
+                                                        # requests only hold a connection while their query runs, and wait for a free one if they are all in use
+
+# DATABASE_URL is created by Heroku and stores the link to our database; Heroku restarts the server whenever it changes it
+# If Heroku's connection pooling (PgBouncer in transaction mode) is attached with `heroku pg:connection-pooling:attach DATABASE_URL --as DATABASE_CONNECTION_POOL`
+# it creates DATABASE_CONNECTION_POOL_URL, and we connect through it so that all of our processes share a small number of real database connections
+# Transaction mode means a real connection is only ours until we commit, so we must not rely on any session state (SET, PREPARE, temporary tables, ...)
+DATABASE_URL = environ.get('DATABASE_CONNECTION_POOL_URL', environ['DATABASE_URL'])
+
+# PgBouncer in transaction mode can run each of our transactions on a different real connection, so statements prepared on one may not exist on the next
+# so only prepare statements (parse and plan them once per connection, then reuse the plan) when connecting to the database directly
+# None turns preparing off, and 0 prepares every statement the first time it is run
+PREPARE_THRESHOLD = None if 'DATABASE_CONNECTION_POOL_URL' in environ else 0
+
+DB_LAST_RETURNED = weakref.WeakKeyDictionary() # when each open database connection was last given back to the pool (a connection is forgotten when it is closed)
+
+
+def connection_returned(connection): # the pool calls this when a connection is opened, and whenever it is given back
+    DB_LAST_RETURNED[connection] = monotonic() # remember when it was last used
+
+
+def check_idle_connection(connection): # the pool calls this before lending a connection out
+    if monotonic() - DB_LAST_RETURNED.get(connection, 0) > DB_IDLE_CHECK_AFTER: # only check connections that haven't been used for a while
+        ConnectionPool.check_connection(connection) # this asks the database if the connection still works, and fails if not, so the pool replaces it
+
+
+# create the database connection pool once when the server starts, instead of connecting (and doing the SSL handshake) on every request
+# Heroku requires that sslmode is set to require
+# every query we run is complete by itself, so autocommit makes each one commit as it runs, saving a separate COMMIT round trip to the database
+# (and there is nothing to commit at all for queries that only read)
+# check_idle_connection makes sure a connection that has been unused for more than DB_IDLE_CHECK_AFTER seconds still works before lending it out,
+# replacing it if Heroku closed it while it was idle (connections used more recently than that are lent out without an extra round trip)
+# TCP keepalives (after 30 seconds idle, then every 10 seconds, giving up after 3 unanswered) notice a connection that was silently dropped
+# within about a minute instead of waiting for the operating system's much longer timeout, and a new connection gives up after DB_CONNECT_TIMEOUT seconds
+DB_POOL = ConnectionPool(
+    DATABASE_URL,
+    min_size=POOL_MIN_SIZE,
+    max_size=POOL_MAX_SIZE,
+    kwargs={
+        'sslmode': 'require',
+        'autocommit': True,
+        'prepare_threshold': PREPARE_THRESHOLD,
+        'connect_timeout': DB_CONNECT_TIMEOUT,
+        'keepalives': 1,
+        'keepalives_idle': 30,
+        'keepalives_interval': 10,
+        'keepalives_count': 3,
+    },
+    configure=connection_returned,
+    reset=connection_returned,
+    check=check_idle_connection,
+    open=True)
+
+
+API_KEY = environ['API_KEY'] # The API key from SendOwl (created from SendOwl account with Manager permissions)
+API_SECRET = environ['API_SECRET'] # The API secret from SendOwl
+PRODUCT_ID = environ['PRODUCT_ID'] # The ID of the product to query
+CHECK_VALID_URL = f'https://www.sendowl.com/api/v1/products/{PRODUCT_ID}/licenses/check_valid' # this is the path to the license check of the correct product
+
+
+class JitteredRetry(Retry): # urllib3's retry rules, but with our own wait between tries
+    def get_backoff_time(self): # urllib3 calls this to find out how long to wait before the next try
+        failures = len(self.history) # how many tries have failed so far (there is always at least one by the time we wait)
+        # the wait doubles after each failed try (TRY_INTERVAL, then twice that, ...) up to MAX_BACKOFF,
+        # and is then randomly made anywhere from half to one and a half times as long, so that requests that failed together don't all retry at the same moment
+        return min(MAX_BACKOFF, TRY_INTERVAL * 2 ** max(failures - 1, 0)) * (0.5 + random.random())
+
+
+# a session for all of our requests to SendOwl, created once so the connection (and SSL handshake) to SendOwl is reused between requests
+SENDOWL_SESSION = requests.Session()
+SENDOWL_SESSION.headers.update({'Accept': 'application/json'}) # the HTTP header, because the response must be in JSON format (this header is required by SendOwl)
+SENDOWL_SESSION.auth = (API_KEY, API_SECRET) # The `auth` is a tuple of the API key and the secret
+# try each request up to TRY_COUNT times if it times out or SendOwl is temporarily down (other errors, like 401 or 404, are not retried)
+# the wait between tries comes from JitteredRetry.get_backoff_time
+# SendOwl's Retry-After header is ignored, since it could ask us to wait far longer than a request can take
+# raise_on_status=False gives us the last response back instead of an exception if every try returns one of these statuses
+SENDOWL_RETRY = JitteredRetry(
+    total=TRY_COUNT - 1, # total counts retries, which come after the first try
+    status_forcelist=[requests.codes.timeout, requests.codes.bad_gateway, requests.codes.service_unavailable, requests.codes.gateway_timeout],
+    allowed_methods=['GET'],
+    respect_retry_after_header=False,
+    raise_on_status=False)
+SENDOWL_SESSION.mount('https://', HTTPAdapter(pool_maxsize=50, max_retries=SENDOWL_RETRY)) # keep up to 50 connections to SendOwl open
+
+# REDIS_URL is created by Heroku when the Heroku Redis add-on is attached; without it, nothing is cached and SendOwl is asked on every request
+# the connection pool makes threads wait for a free connection instead of opening more than 50, and gives up on Redis after a second
+# Heroku Redis gives a rediss:// (SSL) URL whose certificate is self-signed, so it can't be verified and ssl_cert_reqs=None turns the check off
+REDIS_URL = environ.get('REDIS_URL')
+REDIS_SSL_OPTIONS = {'ssl_cert_reqs': None} if REDIS_URL and REDIS_URL.startswith('rediss://') else {}
+VERIFY_CACHE = redis.Redis(connection_pool=redis.BlockingConnectionPool.from_url(REDIS_URL, max_connections=50, timeout=1, socket_timeout=1, socket_connect_timeout=1, **REDIS_SSL_OPTIONS)) if REDIS_URL else None
+REDIS_FAILING = False # whether our last use of Redis failed, so that an outage is only logged once instead of on every request
+
+# the address of a static file host or CDN (for example an S3 bucket behind CloudFront) holding a copy of installers/ and updates.xml
+# if it is set, those requests are redirected there, so our server processes aren't kept busy sending large installers and can keep answering verifications
+DOWNLOADS_URL = environ.get('DOWNLOADS_URL', '').rstrip('/')
+
+REQUEST_COUNTS = queue.Queue() # the (license key, whether it was valid) requests waiting to be counted in the database
 
 app = Flask(__name__) # create new Flask web app with the name of this file
 
@@ -17,78 +137,134 @@ def home(): # just disply a simple Welcome message to test that the server is up
 
 @app.route("/installers/<path:path>")
 def serve_installer(path):
+    if DOWNLOADS_URL: # if the files are hosted elsewhere, send the software there instead of sending the file ourselves
+        return redirect(f'{DOWNLOADS_URL}/installers/{path}')
     return send_from_directory('../installers', path)
 
 @app.route("/updates.xml")
 def serve_updates():
+    if DOWNLOADS_URL: # if the files are hosted elsewhere, send the software there instead of sending the file ourselves
+        return redirect(f'{DOWNLOADS_URL}/updates.xml')
     return send_file('../updates.xml')
 
 @app.route("/verify/<key>/<hid>") # if a request is sent to our url/verify/the key to verify, process it here
 def verify_key(key, hid): # key is the key seeking verification, hid is the unique hardware identifier of the computer
-    connection, cursor = connect_to_db() # create a connection the our database
-                                         # connection is a link to the database for opening, closing and commiting changes
-                                         # cursor is used to access the data inside the database
-    if license_is_stored(key, cursor): # if the license exists in our database already
-        stored_hid = get_stored_hid(key, cursor) # get the HID stored in the database for that key
-        if hid == stored_hid: # the HID in the database must match the one we are sent (otherwise the license key is being used on multiple devices, which is not allowed)
-            code_to_return = request_sendowl(key, hid) # send a request to SendOwl to verify that the key itself is valid if the HID matches
-            if code_to_return == requests.codes.ok: # if SendOwl says that the key is valid
-                update_valid_request_count(key, cursor) # update the valid request count in the database
-                end_db_session(cursor, connection) # end the database access
-                return 'OK' # return a dummy value and a 200 response back to the software
-            else: # otherise if SendOwl says the key is invalid or there is an issue
-                update_invalid_request_count(key, cursor) # update the valid request count in the database
-                end_db_session(cursor, connection) # end the database access
-                abort(code_to_return) # and return the error from SendOwl
-        else: # otherwise, if the HID does not match, no need to even bother checking with SendOwl
-            update_invalid_request_count(key, cursor) # update the valid request count in the database
-            end_db_session(cursor, connection) # so just end the DB access
-            abort(requests.codes.not_found) # and tell the software the code is invalid
-    else: # otherwise if the license key does not exist in our database, try to create it
-        code_to_return = request_sendowl(key, hid) # check with SendOwl that it is valid
-        if code_to_return == requests.codes.ok: # and if it is, 
-            add_license_to_db(key, hid, cursor) # add it to our database with the HID
-            end_db_session(cursor, connection) # and end the DB session
-            return 'OK' # return a dummy OK response to the software
-        else: # if it's not valid according to SendOwl
-            end_db_session(cursor, connection) # end the DB session
-            abort(code_to_return) # return the error from SendOwl
-
-
-def connect_to_db(): # connects to the PostgreSQL database
-    DATABASE_URL = environ['DATABASE_URL'] # this environment variable is created by Heroku and stores the link to our database
-                                           # Heroku could change this at any time so we need to get it on every connection
-    connection = psycopg2.connect(DATABASE_URL, sslmode='require') # connect to the database
-                                                                   # Heroku requires that sslmode is set to require
-    return connection, connection.cursor() # return the connection and a cursor for that connection
+                           # (GET requests here are normally answered by VerifyDispatcher below, before they reach Flask)
+    code_to_return = check_license(key, hid) # check the license and store it in the database if it is new
+    if code_to_return == requests.codes.ok: # if the license is valid
+        return 'OK' # return a dummy value and a 200 response back to the software
+    abort(code_to_return) # otherwise return the error back to the software
 
 
-def request_sendowl(key, hid): # send a request to SendOwl to verify the key
-    API_KEY = environ['API_KEY'] # The API key from SendOwl (created from SendOwl account with Manager permissions)
-    API_SECRET = environ['API_SECRET'] # The API secret from SendOwl
-    PRODUCT_ID = environ['PRODUCT_ID'] # The ID of the product to query
+class VerifyDispatcher: # answers GET /verify/<key>/<hid> straight away, and passes every other request on to Flask
+    # almost all of our requests are verifications, so this skips Flask's URL matching and request setup for them
+    # the responses are the same as the ones verify_key gives through Flask
+    def __init__(self, flask_wsgi_app):
+        self.flask_wsgi_app = flask_wsgi_app # the Flask app that handles every other request
+
+    def __call__(self, wsgi_environ, start_response): # called by gunicorn for every request
+        # the server gives us the path decoded as latin-1, so decode it as UTF-8 the same way Flask does
+        path = wsgi_environ.get('PATH_INFO', '').encode('latin-1').decode('utf-8', 'replace')
+        parts = path.split('/') # '/verify/key/hid' splits into ['', 'verify', 'key', 'hid']
+        if wsgi_environ.get('REQUEST_METHOD') != 'GET' or len(parts) != 4 or parts[1] != 'verify' or not parts[2] or not parts[3]: # if this isn't a verification,
+            return self.flask_wsgi_app(wsgi_environ, start_response) # let Flask handle it
+        try:
+            code_to_return = check_license(parts[2], parts[3]) # check the license and store it in the database if it is new
+        except Exception: # if something went wrong, log it and return an internal server error, like Flask would
+            app.logger.exception(f'Exception on {path} [GET]')
+            code_to_return = requests.codes.server_error
+        if code_to_return == requests.codes.ok: # if the license is valid
+            start_response('200 OK', [('Content-Type', 'text/html; charset=utf-8'), ('Content-Length', '2')])
+            return [b'OK'] # return a dummy value and a 200 response back to the software
+        return default_exceptions[code_to_return]()(wsgi_environ, start_response) # otherwise return the same error page that abort() gives
+
+
+app.wsgi_app = VerifyDispatcher(app.wsgi_app) # put the dispatcher in front of Flask
+
+
+def check_license(key, hid): # work out whether the key is valid for this HID, returning the HTTP code to send back
+    if is_cached_valid(key, hid): # if SendOwl said the key is valid for this HID recently,
+        count_request(key, True) # just count the valid request
+        return requests.codes.ok # and tell the software it is valid without touching the database or asking SendOwl again
+    sendowl_request = spawn(request_sendowl, key, hid) # start a request to SendOwl to verify that the key itself is valid, which runs while we check the database
+    try:
+        status = lookup_license(key, hid) # check whether the key is stored, and with which HID
+    except BaseException: # if the database check fails, the answer from SendOwl isn't needed
+        sendowl_request.kill(block=False)
+        raise
+    if status == 'HID_MISMATCH': # the HID in the database must match the one we are sent (otherwise the license key is being used on multiple devices, which is not allowed)
+        sendowl_request.kill(block=False) # so stop the SendOwl request, there's no need to wait for it
+        return requests.codes.not_found # and tell the software the code is invalid (the database has already counted the invalid request)
+    code_to_return = sendowl_request.get() # wait for SendOwl's answer
+    if status == 'OK': # if the key is already stored with this HID
+        count_request(key, code_to_return == requests.codes.ok) # count the request as valid or invalid depending on what SendOwl said
+    elif code_to_return == requests.codes.ok: # otherwise if the key is new and SendOwl says it is valid
+        if not record_valid_request(key, hid): # store the key with this HID straight away, so no other device can take it
+            # this only fails if another device stored the key in between our two queries
+            count_request(key, False) # so this is really an invalid request from a second device
+            return requests.codes.not_found # and the code is invalid for it
+    if code_to_return == requests.codes.ok: # if the key is valid
+        cache_valid(key, hid) # remember that the key is valid for this HID for a while (failures are never cached)
+    return code_to_return # return the result from SendOwl
+
+
+def cache_key(key, hid): # the name we store a key and HID pair under in Redis
+    return f'verify/{key}/{hid}' # neither the key nor the HID can contain a '/', since they come from the URL path
+
+
+def is_cached_valid(key, hid): # whether SendOwl said this key is valid for this HID within the last CACHE_TTL seconds
+    if VERIFY_CACHE is None: # if there is no cache,
+        return False # we always have to ask SendOwl
+    try:
+        cached = VERIFY_CACHE.get(cache_key(key, hid)) == b'OK'
+    except redis.RedisError: # if Redis is down, don't fail the request because of it
+        redis_failed()
+        return False # just ask SendOwl
+    redis_worked()
+    return cached
+
+
+def cache_valid(key, hid): # remember that SendOwl said this key is valid for this HID, for CACHE_TTL seconds
+    if VERIFY_CACHE is None: # if there is no cache, there is nothing to do
+        return
+    try:
+        VERIFY_CACHE.setex(cache_key(key, hid), CACHE_TTL, b'OK')
+    except redis.RedisError: # if Redis is down, the next request will just ask SendOwl again
+        redis_failed()
+        return
+    redis_worked()
 
-    BASE_API_PATH = f'https://www.sendowl.com/api/v1/products/{PRODUCT_ID}/' # this is the path to the correct product to query
+
+def redis_failed(): # called when talking to Redis fails
+    global REDIS_FAILING
+    if not REDIS_FAILING: # only log the first failure, until Redis works again
+        app.logger.exception('Redis is unavailable, asking SendOwl without the cache')
+        REDIS_FAILING = True
+
+
+def redis_worked(): # called when talking to Redis works
+    global REDIS_FAILING
+    REDIS_FAILING = False # so the next failure is logged again
+
+
+def request_sendowl(key, hid): # send a request to SendOwl to verify the key
     parameters = {'key': key} # the HTTP parameters containing `key=the key we're querying`
-    headers = {'Accept': 'application/json'} # the HTTP header, because the response must be in JSON format (this header is required by SendOwl)
-    for _ in range(TRY_COUNT): # attempt the connection 10 times 
+    # give up on SendOwl DEADLINE seconds from now, however many tries are left, counting every try and every wait between them
+    # (False means that running out of time skips to the end of the `with` block instead of raising an error)
+    with Timeout(DEADLINE, False):
         try:
-            # HTTP GET request to the base path/licenses/check_valid, passing the parameters and header
-            # The `auth` is a tuple of the API key and the secret
-            # Also ensure the request times out after TIMEOUT seconds 
-            request = requests.get(f'{BASE_API_PATH}/licenses/check_valid', params=parameters, headers=headers, auth=(API_KEY, API_SECRET), timeout=TIMEOUT)
-        except requests.exceptions.Timeout: # If the request times out, this exception will be raised, so
-            sleep(TRY_INTERVAL) # wait a bit to avoid overwhelming the server with requests
-            continue # and then continue the loop so we try again
+            # HTTP GET request to the product's licenses/check_valid path, passing the parameters
+            # The session adds the header and auth, reuses an open connection and retries on timeouts
+            # Also ensure each try gives up if it can't connect within CONNECT_TIMEOUT seconds, or SendOwl doesn't respond within TIMEOUT seconds
+            request = SENDOWL_SESSION.get(CHECK_VALID_URL, params=parameters, timeout=(CONNECT_TIMEOUT, TIMEOUT))
+        except requests.exceptions.RequestException: # if the request still fails after TRY_COUNT tries (or can't connect at all),
+            return requests.codes.server_error # tell the software there was an server error
         if request.status_code == requests.codes.ok: # if the request returns the HTTP OK response
-            results = request.json() # parse the data into a JSON object containing info on the license key
+            results = orjson.loads(request.content) # parse the data into a JSON object containing info on the license key
             return handle_results(results, key, hid) # handle the results of the query
-        elif request.status_code == requests.codes.timeout: # if the request timed out on the server end
-            sleep(TRY_INTERVAL) # wait a bit to avoid overwhelming the server
-            continue  # and continue the loop to try again
-        else: # if the request code is neither OK nor a timeout, simply tell the software that there was an internal server error
+        else: # if the request code is not OK, simply tell the software that there was an internal server error
             return requests.codes.server_error
-    return request.codes.server_error # if we made it through the loop TRY_COUNT times without success, tell the software there was an server error
+    return requests.codes.server_error # if we ran out of time, tell the software there was an server error
 
 
 def handle_results(results, key, hid): # handle the results from SendOwl
@@ -102,41 +278,81 @@ def handle_results(results, key, hid): # handle the results from SendOwl
         return requests.codes.ok # so return a dummy response and HTTP OK to the software
 
 
-def get_stored_hid(key, cursor): # retrieve the stored HID from the database for a specific license key
-    cursor.execute(f"SELECT DeviceID FROM Licenses WHERE License='{key}';") # SQL query to select the Device ID matching the given license key
-    device_id, = cursor.fetchone() # get the device ID from the cursor (the comma is because the result is a 1-tuple)
-    return device_id # return the device ID
+def lookup_license(key, hid): # check a license key against the HID stored for it in the database
+    # returns 'NEW' if the key is not stored yet, 'OK' if it is stored with this HID,
+    # or 'HID_MISMATCH' if it is stored with another HID (in which case the invalid request has already been counted)
+    # the checking is done inside the database by the verify_license function from sql/03_verify_license.sql, which Heroku creates before each release
+    # (see app/migrate.py), while new keys are stored by record_valid_request, so the HID rules in both places must be kept the same
+    # borrow a connection to our database from the pool (connection is a link to the database for opening, closing and commiting changes)
+    # only for as long as the query takes, so that no connection is kept waiting while we talk to SendOwl
+    # when the `with` block ends, the connection goes back to the pool
+    with DB_POOL.connection() as connection:
+        cursor = connection.execute("SELECT verify_license(%s, %s);", (key, hid)) # cursor is used to access the data the query returned
+        status, = cursor.fetchone() # get the status from the cursor (the comma is because the result is a 1-tuple)
+    return status
+
 
+def record_valid_request(key, hid): # add the license and hardware key to the database, or increment its valid request count if it is already there
+    # if the key is not stored, a new row is inserted with:
+    #   'key' is the license key
+    #   'hid' is the hardware identifier
+    #   'now' is the current date and time in UTC standard time
+    #   1 is the number of valid requests made for this license key
+    #   0 is the number of invalid requests made for this license key
+    # if the key is stored (ON CONFLICT, which needs the unique index from sql/01_licenses_unique_index.sql), the valid request count is incremented instead,
+    # but only if it is stored for the same HID
+    # RETURNING gives back a row only if the license was inserted or updated, so we know whether the request was counted
+    with DB_POOL.connection() as connection:
+        cursor = connection.execute(
+            "INSERT INTO Licenses VALUES (%s, %s, timestamp with time zone 'now', 1, 0) "
+            "ON CONFLICT (License) DO UPDATE SET ValidRequestCount = Licenses.ValidRequestCount + 1 "
+            "WHERE Licenses.DeviceID = EXCLUDED.DeviceID "
+            "RETURNING DeviceID;",
+            (key, hid))
+        return cursor.fetchone() is not None # whether the request was counted for this HID
 
-def license_is_stored(key, cursor): # whether or not the given key exists in the license database
-    cursor.execute(f"SELECT * FROM Licenses WHERE License='{key}';") # select all licenses matching the given key
-    return len(cursor.fetchall()) > 0 # return whether a license matches the key or not
 
+def count_request(key, valid): # count a valid or invalid request for an already stored license key
+    REQUEST_COUNTS.put_nowait((key, valid)) # the background thread adds it to the database soon, so the request doesn't have to wait for it
 
-def update_valid_request_count(key, cursor): # increment the valid request count field of the given license key
-    cursor.execute(f"SELECT ValidRequestCount FROM Licenses WHERE License='{key}';") # retrive the current valid request count
-    request_count, = cursor.fetchone()
-    new_request_count = request_count + 1 # increment it by one
-    cursor.execute(f"UPDATE Licenses SET ValidRequestCount = {new_request_count} WHERE License='{key}';") # set the new request count
 
+def next_request_count_batch(): # wait for requests to count, then gather up to FLUSH_BATCH_SIZE of them that arrive within FLUSH_INTERVAL seconds
+    batch = [REQUEST_COUNTS.get()] # wait for the first request to count
+    deadline = monotonic() + FLUSH_INTERVAL # and then give others a short time to arrive
+    while len(batch) < FLUSH_BATCH_SIZE:
+        remaining = deadline - monotonic()
+        if remaining <= 0: # if the time is up, stop waiting
+            break
+        try:
+            batch.append(REQUEST_COUNTS.get(timeout=remaining))
+        except queue.Empty: # nothing else arrived in time
+            break
+    return batch
 
-def update_invalid_request_count(key, cursor): # increment the invalid request count field of the given license key
-    cursor.execute(f"SELECT InvalidRequestCount FROM Licenses WHERE License='{key}';") # retrive the current invalid request count
-    request_count, = cursor.fetchone()
-    new_request_count = request_count + 1 # increment it by one
-    cursor.execute(f"UPDATE Licenses SET InvalidRequestCount = {new_request_count} WHERE License='{key}';") # set the new request count
 
+def store_request_counts(batch): # add a batch of counted requests to the database in one query and one commit
+    totals = {} # the number of valid and invalid requests for each license key in the batch
+    for key, valid in batch:
+        valid_count, invalid_count = totals.get(key, (0, 0))
+        totals[key] = (valid_count + 1, invalid_count) if valid else (valid_count, invalid_count + 1)
+    # the keys and counts are sent as three arrays and turned back into rows by unnest, so the query is the same whatever the batch size
+    # each key appears only once in the arrays, since an UPDATE ... FROM only updates each row once
+    # the keys are sorted so that every server process locks the rows it updates in the same order, instead of two processes each waiting on a row the other has locked
+    rows = sorted(totals.items())
+    with DB_POOL.connection() as connection:
+        connection.execute(
+            "UPDATE Licenses SET ValidRequestCount = ValidRequestCount + v.valid, InvalidRequestCount = InvalidRequestCount + v.invalid "
+            "FROM unnest(%s::text[], %s::integer[], %s::integer[]) AS v(license, valid, invalid) WHERE Licenses.License = v.license;",
+            ([key for key, _ in rows], [valid_count for _, (valid_count, _) in rows], [invalid_count for _, (_, invalid_count) in rows]))
 
-def add_license_to_db(key, hid, cursor): # add the license and hardware key to the database with a timestamp and request count of one
-    # 'key' is the license key
-    # 'hid' is the hardware identifier
-    # 'now' is the current date and time in UTC standard time
-    # 1 is the number of valid requests made for this license key
-    # 0 is the number of invalid requests made for this license key
-    cursor.execute(f"INSERT INTO Licenses VALUES ('{key}', '{hid}', timestamp with time zone 'now', 1, 0);") # insert the new row of the table
+
+def flush_request_counts(): # runs forever in a background thread, adding the counted requests to the database in batches
+    while True:
+        batch = next_request_count_batch()
+        try:
+            store_request_counts(batch)
+        except Exception: # if the database is unavailable, these counts are lost, but the thread must keep going for the next ones
+            app.logger.exception(f'Could not store {len(batch)} request counts')
 
 
-def end_db_session(cursor, connection): # commit all changes and close the database connection
-    connection.commit() # commit changes
-    cursor.close() # close the cursor
-    connection.close() # close the DB connection
\ No newline at end of file
+Thread(target=flush_request_counts, daemon=True).start() # start adding counted requests to the database in the background
@@ -0,0 +1,21 @@
+import psycopg # the library used for interaction with PostgreSQL
+
+from os import environ # used to acess environment variables on the server side
+from pathlib import Path # for finding the SQL files
+
+# the SQL files that set up the database, which are run in order of their names
+# each file must be safe to run again, and must hold a single statement (so that statements like CREATE INDEX CONCURRENTLY, which can't run inside a transaction, work)
+SQL_DIRECTORY = Path(__file__).resolve().parent.parent / 'sql'
+
+
+def migrate(): # run every SQL file on the database
+    # connect straight to the database rather than through PgBouncer, since some of the statements take a while
+    # Heroku requires that sslmode is set to require, and autocommit runs each statement by itself rather than in a transaction
+    with psycopg.connect(environ['DATABASE_URL'], sslmode='require', autocommit=True) as connection:
+        for path in sorted(SQL_DIRECTORY.glob('*.sql')):
+            print(f'Running {path.name}') # shows up in the release log on Heroku
+            connection.execute(path.read_text())
+
+
+if __name__ == '__main__': # Heroku runs this before starting each new release (see the Procfile), so the server can rely on the database being set up
+    migrate()
@@ -0,0 +1,8 @@
+-- adds a unique index on the License column of the Licenses table
+-- record_valid_request in app/main.py stores new keys with INSERT ... ON CONFLICT (License), which only works if License is unique
+-- CONCURRENTLY builds the index without locking the table, so verifications keep working while it is built
+-- (it can't run inside a transaction, which is why it is in a file of its own)
+-- if the build fails (for example because a license key is stored more than once), drop the invalid index it leaves behind,
+-- merge the duplicate rows and run this again
+
+CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS licenses_pkey_idx ON Licenses (License);
@@ -0,0 +1,14 @@
+-- makes the unique index from 01_licenses_unique_index.sql the primary key of the Licenses table
+-- this only changes the table's definition, so the table is only locked for a moment (plus a quick check that no License is NULL)
+-- it does nothing if the table already has a primary key, so it is safe to run again
+-- with License indexed, finding a license key (in verify_license, record_valid_request and when counting requests) looks it up in the index
+-- instead of reading through the whole table; to check, `EXPLAIN SELECT DeviceID FROM Licenses WHERE License = 'some key';` should show
+-- an Index Scan using licenses_pkey_idx (on a very small table PostgreSQL may still choose to read the whole table, which is fine)
+
+DO $$
+BEGIN
+    IF NOT EXISTS (SELECT 1 FROM pg_constraint WHERE conrelid = 'licenses'::regclass AND contype = 'p') THEN
+        ALTER TABLE Licenses ADD PRIMARY KEY USING INDEX licenses_pkey_idx;
+    END IF;
+END;
+$$;
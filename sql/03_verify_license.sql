@@ -0,0 +1,23 @@
+-- verify_license(k, h) checks license key k against the HID it is stored with, in a single query from the server
+-- it returns:
+--   'NEW' if the key is not stored yet
+--   'OK' if the key is stored with HID h
+--   'HID_MISMATCH' if the key is stored with a different HID, after counting the invalid request
+-- the HID rules here must stay the same as the ones in check_license and record_valid_request in app/main.py
+-- it is safe to run again, since it replaces any earlier version of the function
+
+CREATE OR REPLACE FUNCTION verify_license(k text, h text) RETURNS text AS $$
+DECLARE
+    stored_hid text; -- the HID the key is stored with
+BEGIN
+    SELECT DeviceID INTO stored_hid FROM Licenses WHERE License = k;
+    IF NOT FOUND THEN -- the key is not stored yet
+        RETURN 'NEW';
+    ELSIF stored_hid = h THEN -- the key is stored with this HID
+        RETURN 'OK';
+    END IF;
+    -- otherwise the key is being used on another device, which is not allowed
+    UPDATE Licenses SET InvalidRequestCount = InvalidRequestCount + 1 WHERE License = k;
+    RETURN 'HID_MISMATCH';
+END;
+$$ LANGUAGE plpgsql;